@@ -1,13 +1,20 @@
+import contextlib
+import gc
+import math
 import os
 import re
 import shutil
 import json
+import struct
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 
 import torch
 import tqdm
 
-from modules import shared, images, sd_models, sd_vae, sd_models_config, errors
+from modules import shared, images, sd_models, sd_vae, sd_models_config, errors, devices
+from backend import memory_management
 from modules.ui_common import plaintext_to_html
 import gradio as gr
 import safetensors.torch
@@ -20,14 +27,12 @@ def run_pnginfo(image):
     geninfo, items = images.read_info_from_image(image)
     items = {**{'parameters': geninfo}, **items}
 
-    info = ''
-    for key, text in items.items():
-        info += f"""
+    info = ''.join(f"""
 <div>
 <p><b>{plaintext_to_html(str(key))}</b></p>
 <p>{plaintext_to_html(str(text))}</p>
 </div>
-""".strip()+"\n"
+""".strip()+"\n" for key, text in items.items())
 
     if len(info) == 0:
         message = "Nothing found in the image."
@@ -64,6 +69,9 @@ def create_config(ckpt_result, config_source, a, b, c):
 
 checkpoint_dict_skip_on_merge = ["cond_stage_model.transformer.text_model.embeddings.position_ids"]
 
+# how much memory the float32 temporaries of all batches being merged at once may take
+merge_max_bytes = 2 * 1024 ** 3
+
 
 def to_half(tensor, enable):
     if enable and tensor.dtype == torch.float:
@@ -72,6 +80,229 @@ def to_half(tensor, enable):
     return tensor
 
 
+float8_dtypes = {getattr(torch, name) for name in dir(torch) if name.startswith("float8_")}
+
+
+def finalize(tensors, dtypes, save_as_half):
+    """Casts tensors merged in float32 to the dtypes they are going to be saved in.
+
+    On CUDA, tensors needing the same conversion are converted together with a foreach copy. On the CPU, which merges by default,
+    foreach copies have no fused kernel, so there this does nothing more than casting each tensor with .to(). Float8 targets, which
+    merging two fp8 models gives, are cast one at a time on CUDA too, since the fused kernel is not known to write float8."""
+
+    results = list(tensors)
+    groups = {}
+    for i, (tensor, dtype) in enumerate(zip(tensors, dtypes)):
+        if save_as_half and dtype == torch.float:
+            dtype = torch.float16
+
+        if tensor.dtype == dtype:
+            continue
+
+        if tensor.device.type == 'cuda' and dtype not in float8_dtypes:
+            groups.setdefault((dtype, tensor.dtype, tensor.device), []).append(i)
+        else:
+            results[i] = tensor.to(dtype)
+
+    for (dtype, _, _), indices in groups.items():
+        sources = [tensors[i] for i in indices]
+        destinations = [torch.empty_like(tensor, dtype=dtype) for tensor in sources]
+        torch._foreach_copy_(destinations, sources)
+
+        for i, destination in zip(indices, destinations):
+            results[i] = destination
+
+    return results
+
+
+class SafetensorsStateDict(Mapping):
+    """Read-only state dict backed by an open safetensors file; each tensor is read from the mmapped file only when it is accessed."""
+
+    def __init__(self, filename):
+        self.exit_stack = contextlib.ExitStack()
+        self.file = self.exit_stack.enter_context(safetensors.safe_open(filename, framework="pt", device="cpu"))
+        self.tensor_names = dict.fromkeys(self.file.keys())
+
+    def __getitem__(self, key):
+        if key not in self.tensor_names:
+            raise KeyError(key)
+
+        return self.file.get_tensor(key)
+
+    def __iter__(self):
+        return iter(self.tensor_names)
+
+    def __len__(self):
+        return len(self.tensor_names)
+
+    def __contains__(self, key):
+        return key in self.tensor_names
+
+    def numel(self, key):
+        return math.prod(self.file.get_slice(key).get_shape())
+
+    def pop(self, key):
+        tensor = self[key]
+        del self.tensor_names[key]
+        return tensor
+
+    def close(self):
+        self.tensor_names.clear()
+        self.exit_stack.close()
+
+
+def load_model(filename):
+    if filename.lower().endswith(".safetensors"):
+        return SafetensorsStateDict(filename)
+
+    return sd_models.load_torch_file(filename)
+
+
+def close_model(state_dict):
+    """Drops the references a state dict returned by load_model holds, and closes the safetensors handle, right away instead of whenever the last reference to it goes away.
+
+    Tensors already taken from a safetensors file share the storage of the whole mmapped file, so the mapping itself stays alive until those tensors are freed as well."""
+
+    if isinstance(state_dict, SafetensorsStateDict):
+        state_dict.close()
+    else:
+        state_dict.clear()
+
+
+re_discard_prefixes = re.compile(r"\^(?:\w|\\\.)+(?:\|\^(?:\w|\\\.)+)*")
+
+
+def discard_matcher(pattern):
+    """Returns a function telling whether a key matches the discard pattern, or None if there is no pattern.
+
+    Patterns made only of anchored literal prefixes, like ^first_stage_model\\.encoder|^model_ema, are checked with str.startswith instead of a regex."""
+
+    if not pattern:
+        return None
+
+    if re_discard_prefixes.fullmatch(pattern):
+        prefixes = tuple(alternative[1:].replace('\\.', '.') for alternative in pattern.split('|'))
+        return lambda key: key.startswith(prefixes)
+
+    return re.compile(pattern).search
+
+
+def without_discarded(keys, is_discarded):
+    if is_discarded is None:
+        return iter(keys)
+
+    return (key for key in keys if not is_discarded(key))
+
+
+def map_keys_threaded(func, keys, batch_size=1, key_bytes=None, max_bytes=None, max_workers=8):
+    """Calls func for lists of up to batch_size keys from a pool of threads; torch releases the GIL while doing the math, so batches are merged concurrently.
+
+    If key_bytes is given, it tells how much memory func needs for a key, and batches are also cut so that all batches being
+    processed at once need at most about max_bytes; a key needing more than a worker's share still gets a batch of its own."""
+
+    workers = min(max_workers, os.cpu_count() or 1)
+
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for key in keys:
+        size = key_bytes(key) if key_bytes else 0
+        if batch and (len(batch) == batch_size or key_bytes and batch_bytes + size > max_bytes // workers):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+
+        batch.append(key)
+        batch_bytes += size
+
+    if batch:
+        batches.append(batch)
+
+    # split torch's own intra-op threads between the workers so that they do not oversubscribe the CPU
+    torch_threads = torch.get_num_threads()
+    torch.set_num_threads(max(1, torch_threads // workers))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        with tqdm.tqdm(total=len(keys)) as progress:
+            for batch, _ in zip(batches, executor.map(func, batches)):
+                progress.update(len(batch))
+                shared.state.sampling_step += len(batch)
+    finally:
+        # if a batch fails, drop the queued ones so the error is reported without merging the rest of the model first
+        executor.shutdown(cancel_futures=True)
+        torch.set_num_threads(torch_threads)
+
+
+# in the order of the safetensors Dtype enum, which is ordered by alignment; older torch versions lack some of these dtypes
+safetensors_dtypes = {
+    getattr(torch, name): code for name, code in [
+        ("bool", "BOOL"),
+        ("uint8", "U8"),
+        ("int8", "I8"),
+        ("float8_e5m2", "F8_E5M2"),
+        ("float8_e4m3fn", "F8_E4M3"),
+        ("int16", "I16"),
+        ("uint16", "U16"),
+        ("float16", "F16"),
+        ("bfloat16", "BF16"),
+        ("int32", "I32"),
+        ("uint32", "U32"),
+        ("float32", "F32"),
+        ("float64", "F64"),
+        ("int64", "I64"),
+        ("uint64", "U64"),
+    ] if hasattr(torch, name)
+}
+safetensors_dtype_order = {dtype: i for i, dtype in enumerate(safetensors_dtypes)}
+
+
+def save_safetensors_streaming(state_dict, filename, metadata=None):
+    """Writes state_dict to a safetensors file one tensor at a time, removing each tensor from state_dict as soon as it is written.
+
+    Tensors may still be views into mmapped source files, and filename may be one of those files, so the data goes to a
+    temporary file that replaces filename only once it is complete; this also never leaves a half-written model behind."""
+
+    header = {}
+    if metadata:
+        # safetensors metadata is str -> str only; values like ss_tag_frequency come back from read_metadata_from_safetensors
+        # parsed into dicts, so they are stored as JSON again, which is how that function reads them
+        header["__metadata__"] = {str(key): value if isinstance(value, str) else json.dumps(value) for key, value in metadata.items()}
+
+    for key, tensor in state_dict.items():
+        if tensor.dtype not in safetensors_dtypes:
+            raise RuntimeError(f"Unsupported dtype {tensor.dtype} for key {key}, it can't be saved as safetensors.")
+
+    # same layout as the reference writer: largest alignment first, then by name, so every tensor's offset stays aligned
+    keys = sorted(state_dict, key=lambda key: (-safetensors_dtype_order[state_dict[key].dtype], key))
+    offset = 0
+    for key in keys:
+        tensor = state_dict[key]
+        size = tensor.numel() * tensor.element_size()
+        header[key] = {"dtype": safetensors_dtypes[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf8')
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+
+    temp_filename = filename + ".tmp"
+    try:
+        with open(temp_filename, "wb") as file:
+            file.write(struct.pack("<Q", len(header_bytes)))
+            file.write(header_bytes)
+
+            for key in keys:
+                tensor = state_dict.pop(key).contiguous()
+                file.write(tensor.reshape(-1).view(torch.uint8).numpy())
+                del tensor
+
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
 def read_metadata(primary_model_name, secondary_model_name, tertiary_model_name):
     metadata = {}
 
@@ -85,7 +316,7 @@ def read_metadata(primary_model_name, secondary_model_name, tertiary_model_name)
     return json.dumps(metadata, indent=4, ensure_ascii=False)
 
 
-def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_model_name, interp_method, multiplier, save_as_half, custom_name, checkpoint_format, config_source, bake_in_vae, discard_weights, save_metadata, add_merge_recipe, copy_metadata_fields, metadata_json):
+def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_model_name, interp_method, multiplier, save_as_half, custom_name, checkpoint_format, config_source, bake_in_vae, discard_weights, save_metadata, add_merge_recipe, copy_metadata_fields, metadata_json, merge_on_gpu=False):
     shared.state.begin(job="model-merge")
 
     def fail(message):
@@ -93,14 +324,19 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         shared.state.end()
         return [*[gr.update() for _ in range(4)], message]
 
+    # these modify their first argument in place to avoid allocating temporaries of the full tensor size;
+    # weighted_sum and add_difference take lists of tensors and process them all with a single foreach op
     def weighted_sum(theta0, theta1, alpha):
-        return ((1 - alpha) * theta0) + (alpha * theta1)
+        torch._foreach_lerp_(theta0, theta1, alpha)
 
     def get_difference(theta1, theta2):
-        return theta1 - theta2
+        if theta1.dtype != torch.promote_types(theta1.dtype, theta2.dtype):
+            return theta1 - theta2
+
+        return theta1.sub_(theta2)
 
     def add_difference(theta0, theta1_2_diff, alpha):
-        return theta0 + (alpha * theta1_2_diff)
+        torch._foreach_add_(theta0, theta1_2_diff, alpha=alpha)
 
     def filename_weighted_sum():
         a = primary_model_info.model_name
@@ -150,97 +386,165 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
     if theta_func2:
         shared.state.textinfo = "Loading B"
         print(f"Loading {secondary_model_info.filename}...")
-        theta_1 = sd_models.load_torch_file(secondary_model_info.filename)
+        theta_1 = load_model(secondary_model_info.filename)
     else:
         theta_1 = None
 
+    # discarded weights are dropped before they are read, so they are never loaded or merged
+    is_discarded = discard_matcher(discard_weights)
+
+    # B's keys that take part in the merge, worked out once so that both passes below only need a set lookup
+    skip_on_merge = frozenset(checkpoint_dict_skip_on_merge)
+    keys_1 = [key for key in without_discarded(theta_1, is_discarded) if 'model' in key and key not in skip_on_merge] if theta_1 is not None else []
+    mergeable_keys = set(keys_1)
+
+    # keys where B and C are identical or C is missing; their difference is zero, so A is left as it is for them
+    unchanged_keys = set()
+
     if theta_func1:
         shared.state.textinfo = "Loading C"
         print(f"Loading {tertiary_model_info.filename}...")
-        theta_2 = sd_models.load_torch_file(tertiary_model_info.filename)
+        theta_2 = load_model(tertiary_model_info.filename)
 
         shared.state.textinfo = 'Merging B and C'
-        shared.state.sampling_steps = len(theta_1.keys())
-        for key in tqdm.tqdm(theta_1.keys()):
-            if key in checkpoint_dict_skip_on_merge:
-                continue
-
-            if 'model' in key:
-                if key in theta_2:
-                    t2 = theta_2.get(key, torch.zeros_like(theta_1[key]))
-                    theta_1[key] = theta_func1(theta_1[key], t2)
+        shared.state.sampling_steps = len(keys_1)
+        theta_1_diff = {}
+
+        def diff_keys(keys):
+            for key in keys:
+                t1 = theta_1[key]
+                t2 = theta_2.get(key)
+                if t2 is None or t1.dtype == t2.dtype and torch.equal(t1, t2):
+                    theta_1_diff[key] = torch.zeros((), dtype=t1.dtype).expand(t1.shape)
+                    unchanged_keys.add(key)
                 else:
-                    theta_1[key] = torch.zeros_like(theta_1[key])
+                    theta_1_diff[key] = theta_func1(t1, t2)
+
+        map_keys_threaded(diff_keys, keys_1)
 
-            shared.state.sampling_step += 1
+        # only the differences are used from here on, so B and C are closed before A is loaded;
+        # B's mapping stays alive anyway, since the differences are computed in place in B's tensors
+        close_model(theta_2)
+        close_model(theta_1)
         del theta_2
+        theta_1 = theta_1_diff
+        gc.collect()
 
         shared.state.nextjob()
 
     shared.state.textinfo = f"Loading {primary_model_info.filename}..."
     print(f"Loading {primary_model_info.filename}...")
-    theta_0 = sd_models.load_torch_file(primary_model_info.filename)
+    theta_0_source = load_model(primary_model_info.filename)
+    keys_0 = list(without_discarded(theta_0_source, is_discarded))
+    theta_0 = dict.fromkeys(keys_0)
 
     print("Merging...")
     shared.state.textinfo = 'Merging A and B'
-    shared.state.sampling_steps = len(theta_0.keys())
-    for key in tqdm.tqdm(theta_0.keys()):
-        if theta_1 and 'model' in key and key in theta_1:
-
-            if key in checkpoint_dict_skip_on_merge:
-                continue
-
-            a = theta_0[key]
-            b = theta_1[key]
-
-            # this enables merging an inpainting model (A) with another one (B);
-            # where normal model would have 4 channels, for latenst space, inpainting model would
-            # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
-            if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
-                if a.shape[1] == 4 and b.shape[1] == 9:
-                    raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
-                if a.shape[1] == 4 and b.shape[1] == 8:
-                    raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
-
-                if a.shape[1] == 8 and b.shape[1] == 4:#If we have an Instruct-Pix2Pix model...
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)#Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
-                    result_is_instruct_pix2pix_model = True
-                else:
-                    assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)
-                    result_is_inpainting_model = True
-            else:
-                theta_0[key] = theta_func2(a, b, multiplier)
-
-            theta_0[key] = to_half(theta_0[key], save_as_half)
-
-        shared.state.sampling_step += 1
-
+    shared.state.sampling_steps = len(keys_0)
+
+    merge_device = devices.device if merge_on_gpu and devices.device.type == 'cuda' else devices.cpu
+
+    if merge_device.type == 'cuda':
+        # the merge needs the VRAM taken by the currently loaded model
+        memory_management.unload_all_models()
+        memory_management.soft_empty_cache()
+
+    def merge_keys(keys):
+        nonlocal result_is_inpainting_model, result_is_instruct_pix2pix_model
+
+        pending = []
+        targets = []
+        sources = []
+
+        for key in keys:
+            a = theta_0_source.pop(key)
+            theta_0[key] = a
+
+            if key in mergeable_keys:
+                b = theta_1[key]
+                unchanged = key in unchanged_keys
+
+                # merge in float32 one batch at a time and cast the results back at the end of the batch;
+                # batches are sized so that the float32 temporaries of all batches merged at once stay within merge_max_bytes,
+                # except for single keys larger than a worker's share of it
+
+                dtype = torch.promote_types(a.dtype, b.dtype)
+                merged = a if unchanged else a.to(merge_device, non_blocking=True).float()
+                if merged is a and not unchanged and not isinstance(theta_0_source, SafetensorsStateDict):
+                    # float32 tensors already on the merge device come back as they are, and the merge is done in place;
+                    # tensors from torch.load can share storage with each other, so they are copied to not merge a key twice
+                    merged = a.clone()
+
+                target = merged
+
+                # this enables merging an inpainting model (A) with another one (B);
+                # where normal model would have 4 channels, for latenst space, inpainting model would
+                # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
+                if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
+                    if a.shape[1] == 4 and b.shape[1] == 9:
+                        raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
+                    if a.shape[1] == 4 and b.shape[1] == 8:
+                        raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
+
+                    if a.shape[1] == 8 and b.shape[1] == 4:#If we have an Instruct-Pix2Pix model...
+                        target = merged[:, 0:4, :, :]#Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
+                        result_is_instruct_pix2pix_model = True
+                    else:
+                        assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
+                        target = merged[:, 0:4, :, :]
+                        result_is_inpainting_model = True
+
+                    dtype = a.dtype
+
+                pending.append((key, merged, dtype))
+                if not unchanged:
+                    targets.append(target)
+                    sources.append(b.to(merge_device, non_blocking=True).float())
+            elif save_as_half and not theta_func2 and a.dtype == torch.float:
+                theta_0[key] = a.half()
+
+        if targets:
+            theta_func2(targets, sources, multiplier)
+
+        if pending:
+            pending_keys, merged_tensors, dtypes = zip(*pending)
+            for key, tensor in zip(pending_keys, finalize(merged_tensors, dtypes, save_as_half)):
+                theta_0[key] = tensor.to(devices.cpu)
+
+    def merge_key_bytes(key):
+        if key not in mergeable_keys or key in unchanged_keys:
+            return 0
+
+        numel = theta_0_source.numel(key) if isinstance(theta_0_source, SafetensorsStateDict) else theta_0_source[key].numel()
+
+        # float32 copies of both A and B
+        return numel * 4 * 2
+
+    # on the GPU, batches are merged one at a time: copies from unpinned memory block anyway, so more threads would only take more VRAM
+    map_keys_threaded(merge_keys, keys_0, batch_size=16, key_bytes=merge_key_bytes, max_bytes=merge_max_bytes, max_workers=1 if merge_device.type == 'cuda' else 8)
+
+    close_model(theta_0_source)
+    if theta_1 is not None:
+        close_model(theta_1)
+    del theta_0_source
     del theta_1
+    gc.collect()
+
+    if merge_device.type == 'cuda':
+        devices.torch_gc()
 
     bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
     if bake_in_vae_filename is not None:
         print(f"Baking in VAE from {bake_in_vae_filename}")
         shared.state.textinfo = 'Baking in VAE'
-        vae_dict = sd_vae.load_torch_file(bake_in_vae_filename)
+        vae_dict = load_model(bake_in_vae_filename)
 
-        for key in vae_dict.keys():
-            theta_0_key = 'first_stage_model.' + key
-            if theta_0_key in theta_0:
-                theta_0[theta_0_key] = to_half(vae_dict[key], save_as_half)
+        baked_keys = [key for key in vae_dict if 'first_stage_model.' + key in theta_0]
+        theta_0.update({'first_stage_model.' + key: to_half(vae_dict[key], save_as_half) for key in baked_keys})
 
+        close_model(vae_dict)
         del vae_dict
 
-    if save_as_half and not theta_func2:
-        for key in theta_0.keys():
-            theta_0[key] = to_half(theta_0[key], save_as_half)
-
-    if discard_weights:
-        regex = re.compile(discard_weights)
-        for key in list(theta_0):
-            if re.search(regex, key):
-                theta_0.pop(key, None)
-
     ckpt_dir = shared.cmd_opts.ckpt_dir or sd_models.model_path
 
     filename = filename_generator() if custom_name == '' else custom_name
@@ -292,7 +596,6 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         sd_merge_models = {}
 
         def add_model_metadata(checkpoint_info):
-            checkpoint_info.calculate_shorthash()
             sd_merge_models[checkpoint_info.sha256] = {
                 "name": checkpoint_info.name,
                 "legacy_hash": checkpoint_info.hash,
@@ -301,6 +604,12 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
 
             sd_merge_models.update(checkpoint_info.metadata.get("sd_merge_models", {}))
 
+        # hashing reads whole files, so do all input models at once
+        checkpoint_infos = list(dict.fromkeys(info for info in [primary_model_info, secondary_model_info, tertiary_model_info] if info))
+        with ThreadPoolExecutor(max_workers=len(checkpoint_infos)) as executor:
+            for future in [executor.submit(info.calculate_shorthash) for info in checkpoint_infos]:
+                future.result()
+
         add_model_metadata(primary_model_info)
         if secondary_model_info:
             add_model_metadata(secondary_model_info)
@@ -312,7 +621,7 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
 
     _, extension = os.path.splitext(output_modelname)
     if extension.lower() == ".safetensors":
-        safetensors.torch.save_file(theta_0, output_modelname, metadata=metadata if len(metadata)>0 else None)
+        save_safetensors_streaming(theta_0, output_modelname, metadata=metadata if len(metadata)>0 else None)
     else:
         torch.save(theta_0, output_modelname)
 
@@ -1,7 +1,7 @@
 import os
 import gradio as gr
 
-from modules import sd_models, sd_vae, errors, extras, call_queue
+from modules import sd_models, sd_vae, errors, extras, call_queue, devices
 from modules.ui_components import FormRow
 from modules.ui_common import create_refresh_button
 
@@ -83,6 +83,7 @@ class UiCheckpointMerger:
                     with FormRow():
                         self.checkpoint_format = gr.Radio(choices=["ckpt", "safetensors"], value="safetensors", label="Checkpoint format", elem_id="modelmerger_checkpoint_format")
                         self.save_as_half = gr.Checkbox(value=False, label="Save as float16", elem_id="modelmerger_save_as_half")
+                        self.merge_on_gpu = gr.Checkbox(value=False, label="Merge on GPU", visible=devices.device.type == 'cuda', elem_id="modelmerger_merge_on_gpu")
 
                     with FormRow():
                         with gr.Column():
@@ -141,6 +142,7 @@ class UiCheckpointMerger:
                 self.add_merge_recipe,
                 self.copy_metadata_fields,
                 self.metadata_json,
+                self.merge_on_gpu,
             ],
             outputs=[
                 self.primary_model_name,